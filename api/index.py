@@ -3,11 +3,19 @@ import sys
 import subprocess
 import time
 import io
+import math
 import asyncio
 import tempfile
 import threading
+import fcntl
+import functools
+import shutil
+import queue
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from typing import List, NamedTuple, Optional
-from dataclasses import dataclass
 
 # --- VERCEL ENVIRONMENT SETUP ---
 # 1. Tell Python where to find your custom built FFmpeg libraries (.so files)
@@ -26,28 +34,122 @@ try:
     from fastapi import FastAPI, HTTPException, Request
     from fastapi.middleware.cors import CORSMiddleware
     from fastapi.responses import JSONResponse
-    from pydantic import BaseModel, HttpUrl
+    from pydantic import BaseModel, Field, HttpUrl
     PYAV_AVAILABLE = True
 except ImportError as e:
     PYAV_AVAILABLE = False
     IMPORT_ERROR = str(e)
 
+# libuv-backed loop: cheaper call_soon_threadsafe wakeups from the packager
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 # --- CONFIGURATION ---
-CODEC_MAP = {"opus": "webm", "aac": "mp4", "mp3": "mp3", "vorbis": "ogg"}
+PIPE_SIZE = 1 << 20  # yt-dlp -> PyAV pipe; Linux defaults to 64KB
+UPLOAD_SLICE = 1 << 18  # Bytes handed to aiohttp per body write
+MAX_UPLOADS = 4  # Concurrent uploads per request, also the conveyor belt depth
+WRITER_DEPTH = 8  # Muxed slices a chunk may buffer before the muxer waits on its upload
+# Providers known to take chunked bodies; the rest get a sized body, as before
+STREAMED_UPLOADS = frozenset(os.environ.get("STREAMED_UPLOADS", "assemblyai").split(","))
+DEMUX_AHEAD = 4096  # Packets the demuxer may read ahead while a chunk is muxed (~80s of Opus)
+DEBUG = os.environ.get("DEBUG", "").lower() in ("1", "true", "yes")
+CHUNK_DURATION = 1800  # Seconds per shipped chunk
+BUFFER_TAIL = 600  # Extra seconds demuxed past a chunk before it is cut
+# Ogg carries a lone Opus track with less framing than WebM's Matroska blocks
+OPUS_CONTAINER = os.environ.get("OPUS_CONTAINER", "ogg")
+CODEC_MAP = MappingProxyType({"opus": OPUS_CONTAINER, "aac": "mp4", "mp3": "mp3", "vorbis": "ogg"})
+# Output is streamed and never seekable, so mp4 has to be fragmented
+MUX_OPTIONS = MappingProxyType({"mp4": {"movflags": "empty_moov+default_base_moof", "frag_duration": "10000000"}})
 
 class StreamRequest(BaseModel):
     url: HttpUrl
     cookies: str
     po_token: str
     provider: str = "deepgram" 
-    chunk_duration: int = 1800   
-    buffer_tail: int = 600      
+    chunk_duration: int = Field(CHUNK_DURATION, gt=0)  # A chunk must hold at least one packet
+    buffer_tail: int = BUFFER_TAIL
 
 class Cargo(NamedTuple):
-    buffer: io.BytesIO
+    stream: 'QueueWriter'
     index: int
-    mime_type: str
-    size_mb: float
+
+class QueueWriter(io.RawIOBase):
+    # Write-only file feeding muxer output to the event loop, with bounded backpressure
+    def __init__(self, loop, depth=WRITER_DEPTH):
+        super().__init__()
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.slots = threading.Semaphore(depth)
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        while not self.aborted:
+            if self.slots.acquire(timeout=1):
+                break
+        if self.aborted:
+            return len(b)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, bytes(b))
+        return len(b)
+
+    def finish(self, error=None):
+        # None ends the chunk cleanly; an exception makes get() fail the upload
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, error)
+
+    async def get(self):
+        chunk = await self.queue.get()
+        if isinstance(chunk, BaseException):
+            raise ConnectionAbortedError("chunk mux failed") from chunk
+        if chunk is not None:
+            self.slots.release()
+        return chunk
+
+    def abort(self):
+        self.aborted = True
+        self.slots.release()  # Wake a blocked write right away
+
+class ConveyorBelt:
+    # Bounded handoff from the packager thread to the shipper; put() fails once closed
+    def __init__(self, loop, maxsize=8):
+        self.loop = loop
+        self.items = deque()
+        self.ready = asyncio.Event()
+        self.slots = threading.Semaphore(maxsize)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def put(self, item):
+        while not self.closed:
+            if self.slots.acquire(timeout=1):
+                break
+        with self.lock:
+            if self.closed:
+                raise BrokenPipeError("shipper is gone")
+            self.items.append(item)
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            stranded = list(self.items)
+        # Cargo nobody will ship must not keep the muxer waiting on its writer
+        for cargo in stranded:
+            if cargo is not None:
+                cargo.stream.abort()
+
+    async def get(self):
+        # `set` only ever runs on the loop, so clearing here cannot lose a wakeup
+        while not self.items:
+            self.ready.clear()
+            await self.ready.wait()
+        item = self.items.popleft()
+        self.slots.release()
+        return item
 
 app = FastAPI()
 
@@ -59,41 +161,93 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def open_packager_pool():
+    # Packager threads are reused across requests instead of spawned per request.
+    # Kept apart from the loop's default executor, which getaddrinfo relies on.
+    app.state.packager_pool = ThreadPoolExecutor(
+        max_workers=int(os.environ.get("PACKAGER_POOL", 4)), thread_name_prefix="pkg"
+    )
+
+@app.on_event("shutdown")
+async def close_packager_pool():
+    app.state.packager_pool.shutdown(wait=False)
+
+@app.on_event("startup")
+async def open_session():
+    # One pool for every request, so provider connections and DNS are reused
+    app.state.session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+
+@app.on_event("shutdown")
+async def close_session():
+    await app.state.session.close()
+
 # --- DIAGNOSTIC HELPERS ---
+# Binaries don't change for the life of the process, so probe them once
+@functools.lru_cache(maxsize=1)
 def get_binary_status():
     results = {}
     for name in ["ffmpeg", "ffprobe", "deno", "yt-dlp"]:
-        try:
-            path = subprocess.check_output(["which", name], text=True).strip()
-            results[name] = f"OK: {path}"
-        except:
-            results[name] = "MISSING"
+        # shutil.which only stats PATH entries; no `which` child process
+        path = shutil.which(name)
+        results[name] = f"OK: {path}" if path else "MISSING"
     return results
 
+@functools.lru_cache(maxsize=1)
+def find_deno():
+    # Use full path for Deno if found in bin
+    deno_bin = os.path.join(BIN_PATH, "deno")
+    return deno_bin if os.path.isfile(deno_bin) and os.access(deno_bin, os.X_OK) else None
+
 # --- CORE LOGIC (REUSED FROM PREVIOUS) ---
 
-def create_package(packets: List['av.Packet'], input_stream, max_dur: float, fmt: str):
-    output_mem = io.BytesIO()
-    with av.open(output_mem, mode="w", format=fmt) as container:
-        stream = container.add_stream(input_stream.codec_context.name)
-        stream.time_base = input_stream.time_base
-        if input_stream.codec_context.extradata:
-            stream.codec_context.extradata = input_stream.codec_context.extradata
-        base_dts = packets[0].dts
-        base_pts = packets[0].pts
-        cutoff_idx = 0
-        for i, pkt in enumerate(packets):
-            rel_time = float(pkt.dts - base_dts) * input_stream.time_base
-            if rel_time < max_dur:
+def open_pipe():
+    r, w = os.pipe2(os.O_CLOEXEC)
+    try:
+        fcntl.fcntl(w, getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_SIZE)
+    except OSError:
+        pass  # Above /proc/sys/fs/pipe-max-size; keep the default
+    return r, w
+
+def open_source(fd: int):
+    # FFmpeg's pipe: protocol reads the fd itself; buffered file object as fallback
+    try:
+        return av.open(f"pipe:{fd}", mode="r")
+    except av.error.ProtocolNotFoundError:
+        return av.open(os.fdopen(fd, "rb", buffering=PIPE_SIZE, closefd=False), mode="r")
+
+def dts_span(seconds: float, time_base) -> int:
+    # Smallest dts delta reaching `seconds`, so loops compare ints, not Fractions
+    return math.ceil(seconds * time_base.denominator / time_base.numerator)
+
+def create_package(packets: List['av.Packet'], input_stream, max_dur: float, fmt: str, writer: QueueWriter):
+    try:
+        with av.open(writer, mode="w", format=fmt, options=MUX_OPTIONS.get(fmt, {})) as container:
+            stream = container.add_stream(input_stream.codec_context.name)
+            stream.time_base = input_stream.time_base
+            if input_stream.codec_context.extradata:
+                stream.codec_context.extradata = input_stream.codec_context.extradata
+            base_dts = packets[0].dts
+            base_pts = packets[0].pts
+            cutoff_dts = dts_span(max_dur, input_stream.time_base)
+            out = []
+            for pkt in packets:
+                if pkt.dts - base_dts >= cutoff_dts:
+                    break
                 pkt.dts -= base_dts
                 pkt.pts -= base_pts
                 pkt.stream = stream
-                container.mux(pkt)
-                cutoff_idx = i
-            else:
-                break
-    output_mem.seek(0)
-    return output_mem, cutoff_idx, round(output_mem.getbuffer().nbytes / 1024 / 1024, 2)
+                out.append(pkt)
+            # One call for the whole chunk; PyAV loops over the list in Cython
+            container.mux(out)
+    except BaseException as e:
+        # Fail the upload rather than let the provider store a truncated chunk
+        writer.finish(e)
+        raise
+    writer.finish()
+    return len(out) - 1
 
 async def ship_cargo(session, cargo, provider, results):
     # (Same as previous shipper logic)
@@ -104,17 +258,72 @@ async def ship_cargo(session, cargo, provider, results):
     else:
         url = "https://manage.deepgram.com/storage/assets"
     
+    sent = 0
+
+    async def payload():
+        # Coalesce the muxer's small writes so aiohttp sends full-size chunks
+        nonlocal sent
+        parts, pending = [], 0
+        while (chunk := await cargo.stream.get()) is not None:
+            parts.append(chunk)
+            pending += len(chunk)
+            if pending >= UPLOAD_SLICE:
+                sent += pending
+                yield b"".join(parts)
+                parts, pending = [], 0
+        if parts:
+            sent += pending
+            yield b"".join(parts)
+
+    if provider in STREAMED_UPLOADS:
+        data = payload()
+    else:
+        # Not known to accept chunked bodies: collect the chunk and send it sized,
+        # without joining the slices into a second whole-chunk copy
+        parts = [piece async for piece in payload()]
+        headers = {**headers, "Content-Length": str(sum(map(len, parts)))}
+
+        async def replay():
+            parts.reverse()
+            while parts:
+                yield parts.pop()  # Release each slice once it is handed off
+
+        data = replay()
+
+    async with session.post(url, headers=headers, data=data) as resp:
+        body = await resp.json()
+        results.append({"index": cargo.index, "status": resp.status, "size_mb": round(sent / 1024 / 1024, 2), "body": body})
+
+def stash_cookies(cookies: str):
+    # memfd passed as /proc/self/fd/N, else a /dev/shm (or /tmp) file; returns (path, fd)
     try:
-        async with session.post(url, headers=headers, data=cargo.buffer) as resp:
-            body = await resp.json()
-            results.append({"index": cargo.index, "status": resp.status, "body": body})
+        fd = os.memfd_create("cookies")
+    except (AttributeError, OSError):
+        tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+        with tempfile.NamedTemporaryFile(mode="w", dir=tmp_dir, suffix=".txt", delete=False) as tf:
+            tf.write(cookies)
+        return tf.name, None
+    os.write(fd, cookies.encode())
+    return f"/proc/self/fd/{fd}", fd
+
+def discard_cookies(path: str, fd: Optional[int]):
+    if fd is not None:
+        os.close(fd)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def run_demuxer(container, stream, packets: queue.Queue, errors: list):
+    # Demux stage: feeds timestamped packets to the mux stage, `None` at the end
+    try:
+        for packet in container.demux(stream):
+            if packet.dts is not None:
+                packets.put(packet)
+    except Exception as e:
+        errors.append(e)
     finally:
-        cargo.buffer.close()
+        packets.put(None)
 
-def run_packager(loop, conveyor_belt, req, cookie_path):
-    # Use full path for Deno if found in bin
-    deno_bin = os.path.join(BIN_PATH, "deno")
-    
+def run_packager(loop, conveyor_belt, req, cookie_path, cookie_fd):
     cmd = [
         sys.executable, "-m", "yt_dlp",
         "-f", "ba",
@@ -123,31 +332,75 @@ def run_packager(loop, conveyor_belt, req, cookie_path):
         "-o", "-", str(req.url)
     ]
     
-    if os.path.exists(deno_bin):
+    deno_bin = find_deno()
+    if deno_bin:
         cmd.extend(["--js-runtimes", f"deno:{deno_bin}"])
 
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    r = proc = container = None
     try:
-        container = av.open(proc.stdout, mode="r")
+        r, w = open_pipe()
+        try:
+            # With DEBUG, yt-dlp inherits our stderr directly; no reader thread needed
+            proc = subprocess.Popen(
+                cmd, stdout=w, stderr=None if DEBUG else subprocess.DEVNULL,
+                pass_fds=() if cookie_fd is None else (cookie_fd,),
+            )
+        finally:
+            os.close(w)
+        container = open_source(r)
         stream = container.streams.audio[0]
         out_fmt = CODEC_MAP.get(stream.codec_context.name, "matroska")
         
+        def package(packets, max_dur, box_id):
+            # Hand the cargo to the shipper first so the upload runs while we mux
+            writer = QueueWriter(loop)
+            conveyor_belt.put(Cargo(writer, box_id))
+            return create_package(packets, stream, max_dur, out_fmt, writer)
+
+        threshold_dts = dts_span(req.chunk_duration + req.buffer_tail, stream.time_base)
         buffer = []
+        base_dts = None  # dts of buffer[0], refreshed only when a chunk is cut
         box_id = 0
-        for packet in container.demux(stream):
-            if packet.dts is None: continue
-            buffer.append(packet)
-            if float(packet.dts - buffer[0].dts) * stream.time_base >= (req.chunk_duration + req.buffer_tail):
-                mem, cutoff, size = create_package(buffer, stream, req.chunk_duration, out_fmt)
-                asyncio.run_coroutine_threadsafe(conveyor_belt.put(Cargo(mem, box_id, f"audio/{out_fmt}", size)), loop)
-                buffer = buffer[cutoff+1:]
-                box_id += 1
+        drained = False
+
+        # Demux on its own thread so yt-dlp keeps draining while a chunk is muxed
+        packets, errors = queue.Queue(maxsize=DEMUX_AHEAD), []
+        demuxer = threading.Thread(target=run_demuxer, args=(container, stream, packets, errors), name="pkg-demux", daemon=True)
+        demuxer.start()
+        try:
+            while (packet := packets.get()) is not None:
+                buffer.append(packet)
+                if base_dts is None:
+                    base_dts = packet.dts
+                if packet.dts - base_dts >= threshold_dts:
+                    cutoff = package(buffer, req.chunk_duration, box_id)
+                    # Demuxed packets already share their payload by refcount; dropping
+                    # the shipped ones in place releases it without copying the tail
+                    del buffer[:cutoff+1]
+                    base_dts = buffer[0].dts if buffer else None
+                    box_id += 1
+            drained = True
+        finally:
+            if not drained:
+                # Mux failed: end the input and unblock the demuxer so it can exit
+                proc.kill()
+                while packets.get() is not None:
+                    pass
+            demuxer.join()
+        if errors:
+            raise errors[0]
         if buffer:
-            mem, _, size = create_package(buffer, stream, 999999, out_fmt)
-            asyncio.run_coroutine_threadsafe(conveyor_belt.put(Cargo(mem, box_id, f"audio/{out_fmt}", size)), loop)
+            package(buffer, 999999, box_id)
     finally:
-        proc.kill()
-        asyncio.run_coroutine_threadsafe(conveyor_belt.put(None), loop)
+        if proc is not None:
+            proc.kill()
+        # The demuxer has been joined by now; release libav's IO context before its fd
+        if container is not None:
+            container.close()
+        if r is not None:
+            os.close(r)
+        with contextlib.suppress(BrokenPipeError):
+            conveyor_belt.put(None)
 
 # --- ROUTES ---
 
@@ -167,26 +420,42 @@ async def handle_request(req: StreamRequest):
         raise HTTPException(500, f"PyAV not installed: {IMPORT_ERROR}")
     
     loop = asyncio.get_running_loop()
-    conveyor_belt = asyncio.Queue()
+    conveyor_belt = ConveyorBelt(loop, maxsize=MAX_UPLOADS)
+    uploads = asyncio.Semaphore(MAX_UPLOADS)
+    shipments = []
     results = []
     
-    # ALWAYS use /tmp on Vercel
-    with tempfile.NamedTemporaryFile(mode="w", dir="/tmp", suffix=".txt", delete=False) as tf:
-        tf.write(req.cookies)
-        cookie_path = tf.name
+    cookie_path, cookie_fd = stash_cookies(req.cookies)
+    packager = None
 
     try:
-        async with aiohttp.ClientSession() as session:
-            # Start packager thread
-            threading.Thread(target=run_packager, args=(loop, conveyor_belt, req, cookie_path), daemon=True).start()
-            
-            # Consume queue
-            while True:
-                cargo = await conveyor_belt.get()
-                if cargo is None: break
-                await ship_cargo(session, cargo, req.provider, results)
+        # Start packager on the shared pool
+        packager = loop.run_in_executor(app.state.packager_pool, run_packager, loop, conveyor_belt, req, cookie_path, cookie_fd)
+        
+        # Consume queue; stop taking cargo while every upload slot is busy. The slot
+        # is taken first so no cargo is ever held outside a shipment task.
+        while True:
+            await uploads.acquire()
+            cargo = await conveyor_belt.get()
+            if cargo is None:
+                uploads.release()
+                break
+            shipment = asyncio.create_task(ship_cargo(app.state.session, cargo, req.provider, results))
+            # However the upload ends, never leave the muxer blocked on its writer
+            shipment.add_done_callback(lambda _, writer=cargo.stream: writer.abort())
+            shipment.add_done_callback(lambda _: uploads.release())
+            shipments.append(shipment)
+        await asyncio.gather(*shipments)
+        await packager
         
+        results.sort(key=lambda r: r["index"])
         return {"success": True, "chunks": results}
     finally:
-        if os.path.exists(cookie_path):
-            os.remove(cookie_path)
+        # If we bail out early, stop the packager instead of leaving it blocked
+        conveyor_belt.close()
+        for shipment in shipments:
+            shipment.cancel()
+        if packager is not None:
+            # Nobody awaits it on this path; its BrokenPipeError is expected
+            packager.add_done_callback(lambda f: f.cancelled() or f.exception())
+        discard_cookies(cookie_path, cookie_fd)